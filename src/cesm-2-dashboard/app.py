@@ -4,8 +4,11 @@ import geoviews as gv
 import panel as pn
 import param
 from datetime import datetime
-from stratus import get_data_files
+from functools import partial
+from stratus import get_data_files, sync_data_files, file_signatures
 import os
+import tiles
+import catalog
 
 from dask.distributed import Client
 import dask
@@ -35,7 +38,7 @@ opts.defaults(
 # This is defined by the name we gave the Dask Scheduler Pod in the Helm Chart
 # We can connect to the Dask Scheduler by name and port on K8s since it's in the same Deployment
 # The Dask image should be customized to contain the data & packages needed
-CLUSTER_TYPE = 'scheduler:8786'
+CLUSTER_TYPE = os.environ.get('CLUSTER_TYPE', 'scheduler:8786')
 
 # Use LocalCluster if you are not going to build and deploy a Dask cluster
 #CLUSTER_TYPE='LocalCluster'
@@ -43,6 +46,14 @@ CLUSTER_TYPE = 'scheduler:8786'
 
 PERSIST_DATA = True
 
+# Serve the map as cached, pre-colormapped XYZ tiles from the /tiles route (see tiles.py)
+# instead of sending the raw array of every frame to the browser.
+# Requires `panel serve app.py --plugins tiles`
+USE_TILES = True
+
+# Tile layers are in Web Mercator, every element of the tile-mode map must use the same projection
+TILE_PROJECTION = crs.GOOGLE_MERCATOR
+
 print(f"{CLUSTER_TYPE = }")
 
 if CLUSTER_TYPE == 'PBSCluster':
@@ -79,49 +90,64 @@ else:
 
 # Try and download the files from Stratus if they don't exist
 # Skip if they do
-data_path = '/home/mambauser/app/LENS2-ncote-dashboard/data_files'
+data_path = os.environ.get('LENS2_DATA_PATH', '/home/mambauser/app/LENS2-ncote-dashboard/data_files')
 isExist = os.path.exists(data_path)
 if isExist:
     pass
 else:
     get_data_files()
 
-parent_dir = Path('/home/mambauser/app/LENS2-ncote-dashboard/data_files/mean/')
-files = list(parent_dir.glob('*.nc'))
-print(*[f.name for f in files], sep=', ') 
-
-ds = xr.open_mfdataset(files, parallel=True)
-ds = ds.convert_calendar('standard')
-ds = ds.assign_coords(lon=(((ds.lon + 180) % 360) - 180))
-ds = ds.roll(lon=int(len(ds['lon']) / 2), roll_coords=True)
-
-# rename variables as "long_name (unit)"
-ds = ds.rename({k:f"{ds[k].attrs['long_name']} ({ds[k].attrs.get('units', 'unitless')})" for k in sorted(list(ds.keys()), reverse=True)})
+# Variables are loaded (and persisted) when a session first selects them,
+# and the least recently used ones are released once this budget is exceeded
+VARIABLE_MEMORY_BUDGET = os.environ.get('VARIABLE_MEMORY_BUDGET', '4GiB')
+
+# The Dask workers read their own copies of the data files (downloaded by prepare.sh).
+# With SYNC_FROM_STRATUS, every catalog refresh first downloads new and updated files from
+# Stratus here and on every worker; in any case a changed variable is only swapped in once
+# all workers report the same files as this process.
+SYNC_FROM_STRATUS = os.environ.get('SYNC_FROM_STRATUS', str(CLUSTER_TYPE.startswith('scheduler'))).lower() == 'true'
+
+def sync_cluster_data_files():
+    sync_data_files(data_path)
+    client.run(sync_data_files, data_path)
+
+def worker_file_signatures(paths):
+    return list(client.run(file_signatures, paths).values())
+
+data_catalog = catalog.get_catalog(
+    Path(data_path) / 'mean',
+    Path(data_path) / 'std_dev',
+    memory_budget=VARIABLE_MEMORY_BUDGET,
+    persist=PERSIST_DATA,
+    before_refresh=sync_cluster_data_files if SYNC_FROM_STRATUS else None,
+    remote_signatures=worker_file_signatures
+)
 
-if PERSIST_DATA:
-    ds = ds.persist()
-print ('!!!!!!!!!!1')
-std_parent_dir = Path('/home/mambauser/app/LENS2-ncote-dashboard/data_files/std_dev/')
-files = list(std_parent_dir.glob("*.nc"))
-print (files)
+min_year = data_catalog.min_year
+max_year = data_catalog.max_year
 
-std_ds = xr.open_mfdataset(files, parallel=True)
-std_ds = std_ds.convert_calendar('standard')
-std_ds = std_ds.assign_coords(lon=(((std_ds.lon + 180) % 360) - 180))
-std_ds = std_ds.roll(lon=int(len(std_ds['lon']) / 2), roll_coords=True)
+variables = data_catalog.variables
 
-std_ds = std_ds.rename({k:f"{std_ds[k].attrs['long_name']} ({std_ds[k].attrs.get('units', 'unitless')})" for k in sorted(list(std_ds.keys()), reverse=True)})
+# The tile route renders tiles from the same yearly frames the map shows.
+# Only resident variables are rendered, so tile requests never load data or reorder eviction;
+# sessions load their variable through data_catalog.get before asking for frames
+def map_frame(variable, forcing_type, year):
+    mean, _, version = data_catalog.peek_versioned(variable)
+    frame = mean\
+                .sel(time=f'{year}-01-01', method='nearest') \
+                .sel(forcing_type=forcing_type)
+    return frame, version
 
-# rename variables similar to the annual mean dataset
-if PERSIST_DATA:
-    std_ds = std_ds.persist()
+tiles.set_frame_source(map_frame, year_bounds=lambda: (data_catalog.min_year, data_catalog.max_year))
 
-min_year = ds.time.min().dt.year.item()
-max_year = ds.time.max().dt.year.item()
+# New or updated per-variable files in the data directory are picked up without a restart:
+# only the affected variables are rebuilt, and cached tiles and open sessions are updated
+CATALOG_REFRESH_INTERVAL = int(os.environ.get('CATALOG_REFRESH_INTERVAL', 60))
 
-variables = list(sorted(ds.keys(), reverse=True))
+data_catalog.subscribe(tiles.on_catalog_change)
+data_catalog.watch(interval=CATALOG_REFRESH_INTERVAL)
 
-forcing_types = list(ds.coords['forcing_type'].values)
+forcing_types = data_catalog.forcing_types
 
 DESCRIPTION = pn.pane.HTML("""
 <h1>
@@ -230,9 +256,10 @@ class ClimateViewer(param.Parameterized):
     pointer = param.XYCoordinates((0, 0), precedence=-1)
     
     # Plotting parameters
-    cmap = param.ObjectSelector(label='Colormap', default='inferno', objects=['inferno', 'viridis', 'inferno_r', 'kb', 'coolwarm', 'coolwarm_r', 'Blues', 'Blues_r'])
+    cmap = param.ObjectSelector(label='Colormap', default='inferno', objects=tiles.COLORMAPS)
     cbar_controls = ColorbarControls(name='Colorbar Controls')
     show_ts_legend = param.Boolean(default=True, label='Toggle time-series legend')
+    hover_text = param.String(default='', precedence=-1)
 
     # Data parameters
     data_subset = param.Parameter(default=hv.Dataset([]), precedence=-1)
@@ -251,6 +278,10 @@ class ClimateViewer(param.Parameterized):
         self.ts_hv = None
         self._year_marker = None
         self._cbar = None
+        # lon/lat bounds of the box selection, the selection stream reports plot coordinates
+        self._selection_bounds = (0, 0, 0, 0)
+        # everything the tile-mode map was last built from, to skip identical rebuilds
+        self._tile_map_key = None
         
         # setup stream <-> pointer connection
         self._stream = streams.Tap(x=0, y=0)
@@ -263,6 +294,16 @@ class ClimateViewer(param.Parameterized):
         # zoom stream
         self._zoom = streams.RangeXY(x_range=(None, None), y_range=(None, None))
         self._zoom.add_subscriber(self._update_ranges)
+
+        # hover stream, values are looked up in the cached frame on the server
+        self._hover = streams.PointerXY(x=None, y=None)
+        self._hover.add_subscriber(self._update_hover)
+
+        # catalog refreshes arrive on the watcher thread, apply them on this session's document
+        self._doc = pn.state.curdoc
+        data_catalog.subscribe(self._on_catalog_change)
+        if self._doc is not None:
+            pn.state.on_session_destroyed(lambda session_context: data_catalog.unsubscribe(self._on_catalog_change))
         
         # Initialize map
         self._get_map_data()
@@ -279,33 +320,57 @@ class ClimateViewer(param.Parameterized):
     ## DATA
     @param.depends('variable', 'forcing_type', 'year', watch=True)
     def _get_map_data(self):
-        subset = ds[self.variable]\
+        if not self._ensure_variable():
+            return
+        # subsets are loaded right away, so sessions hold numpy data instead of
+        # graphs that pin the persisted variable after the catalog releases it
+        subset = data_catalog.mean(self.variable)\
                     .sel(time=f'{self.year}-01-01', method='nearest') \
                     .sel(forcing_type=self.forcing_type) \
-                    .rename({'lat': 'Latitude', 'lon': 'Longitude'})
+                    .rename({'lat': 'Latitude', 'lon': 'Longitude'}) \
+                    .load()
         subset_hv = hv.Dataset(subset)
 
         self.data_subset = subset_hv
     
     @param.depends('variable', 'forcing_type', 'pointer', watch=True)
     def _get_ts_data(self):
-        ts_mean_subset = ds[self.variable].sel(lat=self.pointer[1], lon=self.pointer[0], method='nearest').sel(forcing_type=self.forcing_type).rename({'lat': 'Latitude', 'lon': 'Longitude'})
+        if not self._ensure_variable():
+            return
+        mean, std = data_catalog.get(self.variable)
+        ts_mean_subset = mean.sel(lat=self.pointer[1], lon=self.pointer[0], method='nearest').sel(forcing_type=self.forcing_type).rename({'lat': 'Latitude', 'lon': 'Longitude'}).load()
         self.ts_mean_subset = hv.Dataset(ts_mean_subset)
-        ts_stddev_subset = std_ds[self.variable].sel(lat=self.pointer[1], lon=self.pointer[0], method='nearest').sel(forcing_type=self.forcing_type).rename({'lat': 'Latitude', 'lon': 'Longitude'})
+        ts_stddev_subset = std.sel(lat=self.pointer[1], lon=self.pointer[0], method='nearest').sel(forcing_type=self.forcing_type).rename({'lat': 'Latitude', 'lon': 'Longitude'}).load()
         self.ts_upper_bound = hv.Dataset(ts_mean_subset + ts_stddev_subset)
         self.ts_lower_bound = hv.Dataset(ts_mean_subset - ts_stddev_subset)
 
     def _get_selection_data(self, bounds):
         minx, miny, maxx, maxy = bounds
+        if USE_TILES:
+            # the tile layer reports Web Mercator coordinates
+            minx, miny = tiles.mercator_to_lonlat(minx, miny)
+            maxx, maxy = tiles.mercator_to_lonlat(maxx, maxy)
+        self._selection_bounds = (minx, miny, maxx, maxy)
         self.selected = self.data_subset.select(Longitude=(minx, maxx), Latitude=(miny, maxy))
 
     def _update_ranges(self, x_range, y_range):
+        if USE_TILES and None not in x_range + y_range:
+            # keep the ranges in lon/lat, the tile layer reports Web Mercator coordinates
+            (x0, y0), (x1, y1) = (
+                tiles.mercator_to_lonlat(x_range[0], y_range[0]),
+                tiles.mercator_to_lonlat(x_range[1], y_range[1])
+            )
+            x_range, y_range = (x0, x1), (y0, y1)
         self.x_range = x_range
         self.y_range = y_range
     
     ## PLOT
     @param.depends('data_subset', 'selected', watch=True)
     def _plot_map(self):
+        if USE_TILES:
+            self._plot_map_tiles()
+            return
+
         plot = gv.Image(
             data = self.data_subset,
             kdims = ['Longitude', 'Latitude'],
@@ -330,12 +395,54 @@ class ClimateViewer(param.Parameterized):
             )
             self.selection_map_hv = plot_selection
 
+    def _plot_map_tiles(self):
+        # The tile layer itself is built in _style_map, here only the selection and clim
+        if not self._selection.bounds == (0, 0, 0, 0):
+            self.selection_map_hv = gv.Image(
+                data = self.selected,
+                kdims = ['Longitude', 'Latitude'],
+                vdims = [self.variable],
+                group = 'Map',
+                label = 'Selection'
+            ).opts(show_legend=True, projection=TILE_PROJECTION)
+
+        if not self.cbar_controls.clim_locked:
+            _, _, values = self._map_frame()
+            self.cbar_controls.clim = (float(np.nanmin(values)), float(np.nanmax(values)))
+
+    def _tile_layer(self):
+        url = tiles.tile_url(
+            self.variable, self.forcing_type, self.year, self.cmap,
+            self.cbar_controls.clim, prefix=pn.state.rel_path or '.',
+            version=data_catalog.version(self.variable)
+        )
+        return gv.WMTS(url, group='Map', label=self.variable).opts(projection=TILE_PROJECTION)
+
+    def _plot_colorbar(self):
+        # The tiles carry no values, a transparent 2x2 proxy image spanning the map
+        # provides the colorbar for the current cmap/clim without sending the frame
+        low, high = self.cbar_controls.clim
+        self._cbar = gv.Image(
+            ([-90, 90], [-42.5, 42.5], np.array([[low, high], [low, high]])),
+            kdims = ['Longitude', 'Latitude'],
+            vdims = [self.variable],
+            group = 'Map',
+            label = self.variable
+        ).opts(
+            cmap=self.cmap,
+            clim=(low, high),
+            alpha=0,
+            colorbar=True, clabel=f'{self.variable}',
+            projection=TILE_PROJECTION
+        )
+
     @param.depends('pointer', watch=True)
     def _plot_pointer_marker(self):
-        plot = hv.Scatter(
-            (self.pointer[0], self.pointer[1])
-        ).opts(color='#52a1d5', marker='x', size=13, line_width=3) * hv.Scatter(
-            (self.pointer[0], self.pointer[1])
+        # gv.Points are projected, so the marker also lands correctly on the tile layer
+        plot = gv.Points(
+            [(self.pointer[0], self.pointer[1])]
+        ).opts(color='#52a1d5', marker='x', size=13, line_width=3) * gv.Points(
+            [(self.pointer[0], self.pointer[1])]
         ).opts(color='#c6e2f2', marker='x', size=10, line_width=1)
 
         self._pointer_marker = plot
@@ -372,10 +479,12 @@ class ClimateViewer(param.Parameterized):
     
     @param.depends('selected', watch=True)
     def _plot_region_ts(self):
-        region_mean = ds[self.variable].sel(
-            lon=slice(self._selection.bounds[0], self._selection.bounds[2]),
-            lat=slice(self._selection.bounds[1], self._selection.bounds[3])
-        ).mean(dim=['lat', 'lon', 'forcing_type'])
+        if not self._ensure_variable():
+            return
+        region_mean = data_catalog.mean(self.variable).sel(
+            lon=slice(self._selection_bounds[0], self._selection_bounds[2]),
+            lat=slice(self._selection_bounds[1], self._selection_bounds[3])
+        ).mean(dim=['lat', 'lon', 'forcing_type']).load()
         region_ts_mean = hv.Curve(
             data = region_mean,
             kdims = ['time'],
@@ -387,6 +496,8 @@ class ClimateViewer(param.Parameterized):
     ## STYLE
     @param.depends('_plot_map', 'cmap', 'cbar_controls.clim', watch=True)
     def _style_map(self):
+        if not self._ensure_variable():
+            return
         if not self.x_range == (0, 0):
             x_range = self.x_range
         else:
@@ -402,13 +513,44 @@ class ClimateViewer(param.Parameterized):
             self.selection_map_hv.opts(
                 cmap=self.cmap,
                 clim=(self.cbar_controls.clim[0], self.cbar_controls.clim[1]),
-                xlim=x_range, ylim=y_range,
                 clone=False
             )
+            if not USE_TILES:
+                self.selection_map_hv.opts(xlim=x_range, ylim=y_range, clone=False)
 
         else:
             alpha = 1
 
+        if USE_TILES:
+            # cmap and clim are baked into the tiles, so restyling swaps the tile URL
+            key = (
+                self.variable, self.forcing_type, self.year, data_catalog.version(self.variable),
+                self.cmap, tuple(self.cbar_controls.clim), x_range, y_range,
+                self._selection.bounds, id(self.selection_map_hv)
+            )
+            if key == self._tile_map_key:
+                return
+            self._tile_map_key = key
+
+            if not x_range == (None, None):
+                (x0, y0), (x1, y1) = (
+                    tiles.lonlat_to_mercator(x_range[0], y_range[0]),
+                    tiles.lonlat_to_mercator(x_range[1], y_range[1])
+                )
+                x_range, y_range = (x0, x1), (y0, y1)
+            self._plot_colorbar()
+            self.map_hv = self._tile_layer().opts(
+                title=f"Average {self.variable} in {self.year}",
+                tools=['box_select', 'tap'],
+                alpha=alpha,
+                global_extent=x_range == (None, None),
+                xlim=x_range, ylim=y_range,
+                responsive='width', aspect='equal',
+                clone=False
+            )
+            self._update_source()
+            return
+
         self.map_hv.opts(
             cmap=self.cmap,
             title=f"Average {self.variable} in {self.year}",
@@ -469,18 +611,86 @@ class ClimateViewer(param.Parameterized):
         self._stream.source = self.map_hv
         self._selection.source = self.map_hv
         self._zoom.source = self.map_hv
+        self._hover.source = self.map_hv
     
+    def _on_catalog_change(self, added, changed, removed):
+        if self._doc is None:
+            self._apply_catalog_change(changed)
+        else:
+            self._doc.add_next_tick_callback(partial(self._apply_catalog_change, changed))
+
+    def _apply_catalog_change(self, changed):
+        self.param.variable.objects = data_catalog.variables
+        self.param.forcing_type.objects = data_catalog.forcing_types
+        if self.forcing_type not in data_catalog.forcing_types:
+            self.forcing_type = data_catalog.forcing_types[0]
+        self.param.year.bounds = (data_catalog.min_year, data_catalog.max_year)
+        self.year = min(max(self.year, data_catalog.min_year), data_catalog.max_year)
+
+        if self._ensure_variable() and self.variable in changed:
+            # reload the map and time-series from the rebuilt variable
+            self.param.trigger('variable')
+
+    def _ensure_variable(self):
+        # A refresh can remove the selected variable before this session is notified,
+        # fall back to the first available one (which re-runs the callbacks)
+        variables = data_catalog.variables
+        if self.variable in variables:
+            return True
+        self.param.variable.objects = variables
+        self.variable = variables[0]
+        return False
+
+    def _map_frame(self):
+        # The data can be swapped by a refresh between reading the version and the frame,
+        # in that case read it again with the new version
+        for attempt in range(2):
+            try:
+                # load the variable (and mark it as used) before reading resident-only frames
+                data_catalog.get(self.variable)
+                return tiles.get_frame(
+                    self.variable, self.forcing_type, self.year, data_catalog.version(self.variable)
+                )
+            except tiles.StaleFrameError:
+                if attempt:
+                    raise
+
+    def _update_hover(self, x, y):
+        if not USE_TILES or x is None or y is None:
+            self.hover_text = ''
+            return
+        lon, lat = tiles.mercator_to_lonlat(x, y)
+        try:
+            value = tiles.sample_frame(self._map_frame(), lon, lat)
+        except LookupError:
+            value = np.nan
+        if np.isnan(value):
+            self.hover_text = ''
+        else:
+            self.hover_text = f'{self.variable} at {lon:.2f}, {lat:.2f}: {value:.4g}'
+
     def _update_click(self, x, y):
+        if USE_TILES:
+            x, y = tiles.mercator_to_lonlat(x, y)
         self.pointer = (x, y)
     
     ## DASHBOARD PLOT ELEMENTS
     @param.depends('_plot_map', '_style_map', '_plot_pointer_marker')
     def view_map(self):      
+        if USE_TILES:
+            overlay = self.map_hv * self._cbar
+            if not self._selection.bounds == (0, 0, 0, 0):
+                overlay = overlay * self.selection_map_hv
+            return (overlay * gf.coastline * self._pointer_marker).opts(projection=TILE_PROJECTION)
         if not self._selection.bounds == (0, 0, 0, 0):
             return self.map_hv * self.selection_map_hv * gf.coastline * self._pointer_marker
         else:
             return self.map_hv * gf.coastline * self._pointer_marker
 
+    @param.depends('hover_text')
+    def view_hover(self):
+        return pn.pane.Str(self.hover_text, height=20, margin=(0, 10))
+
     @param.depends('_plot_ts', '_style_ts', '_plot_year_marker', '_plot_region_ts')
     def view_ts(self):
         if not self._selection.bounds == (0, 0, 0, 0):
@@ -553,6 +763,7 @@ class ClimateViewer(param.Parameterized):
 
         content = pn.Column(
             self.view_map,
+            self.view_hover,
             self.view_ts,
             DESCRIPTION,
             align='center'
@@ -0,0 +1,363 @@
+import hashlib
+import threading
+import time
+import weakref
+from pathlib import Path
+
+import xarray as xr
+from dask.utils import format_bytes, parse_bytes
+
+# This module keeps track of which variables are loaded on the Dask cluster.
+# `panel serve` re-runs app.py for every session, but imported modules are shared,
+# so a single VariableCatalog per data directory is reused by all sessions.
+# Variables are opened lazily, persisted on first use and released again
+# (least recently used first) when the persisted data exceeds the memory budget.
+# `refresh` (or the `watch` thread) picks up new, changed and removed files and
+# rebuilds only the affected variables, then notifies the subscribed sessions.
+# The Dask workers read their own copies of the files: `before_refresh` can sync them,
+# and variables are only swapped in once `remote_signatures` shows every worker
+# has the same files as this process.
+
+
+def normalize(ds):
+    # Common calendar, longitudes in [-180, 180) and "long_name (unit)" variable names
+    ds = ds.convert_calendar('standard')
+    ds = ds.assign_coords(lon=(((ds.lon + 180) % 360) - 180))
+    ds = ds.roll(lon=int(len(ds['lon']) / 2), roll_coords=True)
+    ds = ds.rename({k: display_name(ds[k]) for k in sorted(list(ds.keys()), reverse=True)})
+    return ds
+
+
+def display_name(da):
+    return f"{da.attrs['long_name']} ({da.attrs.get('units', 'unitless')})"
+
+
+class VariableCatalog:
+    def __init__(self, mean_dir, std_dir, memory_budget='4GiB', persist=True,
+                 before_refresh=None, remote_signatures=None):
+        self.mean_dir = Path(mean_dir)
+        self.std_dir = Path(std_dir)
+        self.memory_budget = parse_bytes(memory_budget) if isinstance(memory_budget, str) else memory_budget
+        self.persist = persist
+        # before_refresh() updates the files before every refresh scan,
+        # remote_signatures(paths) returns a {path: (mtime_ns, size) or None} dict per worker
+        self.before_refresh = before_refresh
+        self.remote_signatures = remote_signatures
+
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.Lock()
+        # display name -> (mean raw variable name, mean file, std dev raw variable name, std dev file,
+        #                  file signature, (forcing types, min year, max year))
+        self._files = {}
+        # file -> (file signature, [(display name, raw variable name)], (forcing types, min year, max year))
+        self._index_cache = {}
+        # display name -> (mean DataArray, std dev DataArray, nbytes, open Datasets, file signature)
+        self._resident = {}
+        self._last_used = {}
+        # display name -> lock held while the variable is being loaded
+        self._loading = {}
+        self._listeners = []
+        self._watcher = None
+
+        self._files, coords = self._scan()
+        self.forcing_types, self.min_year, self.max_year = coords
+        print(*[entry[1].name for entry in self._files.values()], sep=', ')
+
+    def _index(self, directory):
+        index = {}
+        seen = set()
+        for path in sorted(directory.glob('*.nc')):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            seen.add(path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+            cached = self._index_cache.get(path)
+            if cached is None or cached[0] != signature:
+                # opening is lazy, this only reads the metadata and coordinates
+                with xr.open_dataset(path) as ds:
+                    names = [(display_name(ds[name]), name) for name in ds.data_vars]
+                    coords = (
+                        list(ds.coords['forcing_type'].values),
+                        ds.time.min().dt.year.item(),
+                        ds.time.max().dt.year.item()
+                    )
+                cached = self._index_cache[path] = (signature, names, coords)
+            for variable, name in cached[1]:
+                index[variable] = (name, path, signature, cached[2])
+
+        # forget files that were deleted from this directory
+        for path in [p for p in self._index_cache if p.parent == directory and p not in seen]:
+            del self._index_cache[path]
+        return index
+
+    def _scan(self):
+        # Returns the files of every variable and the forcing types and year range they span
+        mean_files = self._index(self.mean_dir)
+        std_files = self._index(self.std_dir)
+
+        files = {
+            # the std dev file may store the variable under a different raw name
+            variable: (name, path, std_files[variable][0], std_files[variable][1], (signature, std_files[variable][2]), coords)
+            for variable, (name, path, signature, coords) in mean_files.items()
+            if variable in std_files
+        }
+        if not files:
+            raise FileNotFoundError(f'No variables found in both {self.mean_dir} and {self.std_dir}')
+        return files, self._coords(files)
+
+    @staticmethod
+    def _coords(files):
+        forcing_types = []
+        for variable in sorted(files, reverse=True):
+            forcing_types += [f for f in files[variable][5][0] if f not in forcing_types]
+        min_year = min(entry[5][1] for entry in files.values())
+        max_year = max(entry[5][2] for entry in files.values())
+        return forcing_types, min_year, max_year
+
+    @property
+    def variables(self):
+        return list(sorted(self._files, reverse=True))
+
+    def version(self, variable):
+        # Changes whenever the files backing a variable change, used to key cached results
+        return self._version(self._files[variable][4])
+
+    @staticmethod
+    def _version(signature):
+        return hashlib.sha1(repr(signature).encode()).hexdigest()[:12]
+
+    def _open(self, name, path):
+        # The Dataset is kept so its file handle can be closed when the variable is released
+        ds = xr.open_dataset(path, chunks={})
+        da = normalize(ds[[name]])
+        da = next(iter(da.data_vars.values()))
+        if self.persist:
+            da = da.persist()
+        return da, ds
+
+    def _load(self, files_entry):
+        mean_name, mean_path, std_name, std_path, signature, _ = files_entry
+        mean, mean_ds = self._open(mean_name, mean_path)
+        std, std_ds = self._open(std_name, std_path)
+        return mean, std, mean.nbytes + std.nbytes, (mean_ds, std_ds), signature
+
+    @staticmethod
+    def _close(resident):
+        for ds in resident[3]:
+            ds.close()
+
+    def get(self, variable):
+        # Returns the (mean, std dev) pair of a variable, loading it on first use
+        mean, std, _ = self.get_versioned(variable)
+        return mean, std
+
+    def get_versioned(self, variable):
+        # Returns (mean, std dev, version) read together, so the version always describes the data
+        resident = self._get(variable)
+        return resident[0], resident[1], self._version(resident[4])
+
+    def peek_versioned(self, variable):
+        # Like get_versioned, but only for variables that are already resident and
+        # without touching their last use, raises KeyError otherwise
+        with self._lock:
+            resident = self._resident[variable]
+        return resident[0], resident[1], self._version(resident[4])
+
+    def _get(self, variable):
+        with self._lock:
+            # unknown names raise KeyError before anything is recorded for them
+            files_entry = self._files[variable]
+            self._last_used[variable] = time.monotonic()
+            if variable in self._resident:
+                return self._resident[variable]
+            loading = self._loading.setdefault(variable, threading.Lock())
+
+        # Open and persist outside the catalog lock so resident variables stay available,
+        # the per-variable lock keeps concurrent first requests from loading it twice
+        with loading:
+            with self._lock:
+                if variable in self._resident:
+                    return self._resident[variable]
+                files_entry = self._files[variable]
+
+            resident = self._load(files_entry)
+
+            with self._lock:
+                self._loading.pop(variable, None)
+                current = self._files.get(variable)
+                stale = current is None or current[4] != files_entry[4]
+                if not stale:
+                    self._resident[variable] = resident
+                    print(f'Loaded {variable} ({format_bytes(resident[2])})')
+                    self._evict(keep=variable)
+
+        if stale:
+            # the files were replaced or removed while loading, start over
+            self._close(resident)
+            return self._get(variable)
+        return resident
+
+    def mean(self, variable):
+        return self.get(variable)[0]
+
+    def std(self, variable):
+        return self.get(variable)[1]
+
+    def release(self, variable):
+        # Dropping the last reference lets Dask free the persisted chunks
+        with self._lock:
+            self._last_used.pop(variable, None)
+            resident = self._resident.pop(variable, None)
+            if resident is not None:
+                self._close(resident)
+                print(f'Released {variable}')
+
+    def _evict(self, keep=None):
+        cold = sorted(
+            (v for v in self._resident if v != keep),
+            key=lambda v: self._last_used.get(v, 0)
+        )
+        for variable in cold:
+            if self.resident_bytes <= self.memory_budget:
+                break
+            self.release(variable)
+
+    def refresh(self):
+        # Rebuild only the variables whose files were added, changed or removed.
+        # New data is opened and persisted before it is swapped in under the lock,
+        # so `get` always returns a consistent (mean, std dev) pair.
+        with self._refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        if self.before_refresh is not None:
+            try:
+                self.before_refresh()
+            except Exception as e:
+                # whatever did arrive is still checked against the workers below
+                print(f'Catalog sync failed: {e}')
+
+        files, coords = self._scan()
+        old_files = self._files
+        added = [v for v in files if v not in old_files]
+        removed = [v for v in old_files if v not in files]
+        changed = [v for v in files if v in old_files and files[v][4] != old_files[v][4]]
+
+        pending = self._unsynced(files, added + changed)
+        if pending:
+            # keep serving the previous files until the workers have the same ones, retried next refresh
+            print(f'Catalog refresh deferred, workers have different files for {pending}')
+            for variable in pending:
+                if variable in old_files:
+                    files[variable] = old_files[variable]
+                else:
+                    del files[variable]
+            added = [v for v in added if v not in pending]
+            changed = [v for v in changed if v not in pending]
+            coords = self._coords(files) if files else coords
+
+        coords_changed = coords != (self.forcing_types, self.min_year, self.max_year)
+        if not (added or removed or changed or coords_changed):
+            return
+
+        rebuilt = {}
+        for variable in changed:
+            if variable in self._resident:
+                rebuilt[variable] = self._load(files[variable])
+
+        with self._lock:
+            for variable in removed:
+                self.release(variable)
+            for variable in changed:
+                old = self._resident.pop(variable, None)
+                if old is not None:
+                    self._close(old)
+            self._resident.update(rebuilt)
+            self._files = files
+            self.forcing_types, self.min_year, self.max_year = coords
+            self._evict()
+        print(f'Catalog refreshed: {added = }, {changed = }, {removed = }')
+
+        for listener in self._get_listeners():
+            try:
+                listener(added, changed, removed)
+            except Exception as e:
+                print(f'Catalog listener failed: {e}')
+
+    def _unsynced(self, files, variables):
+        # Variables whose files differ on at least one Dask worker
+        if self.remote_signatures is None or not variables:
+            return []
+        paths = [str(files[v][i]) for v in variables for i in (1, 3)]
+        reports = self.remote_signatures(paths)
+        reports = [{path: sig and tuple(sig) for path, sig in report.items()} for report in reports]
+        return [
+            v for v in variables
+            if any(
+                (report.get(str(files[v][1])), report.get(str(files[v][3]))) != files[v][4]
+                for report in reports
+            )
+        ]
+
+    def watch(self, interval=60):
+        # Poll the data directories for changes in a background thread (once per process)
+        with self._lock:
+            if self._watcher is not None:
+                return
+            self._watcher = threading.Thread(
+                target=self._watch, args=(interval,), name='catalog-watcher', daemon=True
+            )
+            self._watcher.start()
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f'Catalog refresh failed: {e}')
+
+    def subscribe(self, callback):
+        # callback(added, changed, removed) is called after every refresh that changed something.
+        # Only weak references are kept, so closed sessions do not leak.
+        with self._lock:
+            if callback in self._get_listeners():
+                return
+            if hasattr(callback, '__self__'):
+                self._listeners.append(weakref.WeakMethod(callback))
+            else:
+                self._listeners.append(weakref.ref(callback))
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._listeners = [ref for ref in self._listeners if ref() not in (None, callback)]
+
+    def _get_listeners(self):
+        with self._lock:
+            self._listeners = [ref for ref in self._listeners if ref() is not None]
+            return [ref() for ref in self._listeners]
+
+    @property
+    def resident_bytes(self):
+        with self._lock:
+            return sum(resident[2] for resident in self._resident.values())
+
+    @property
+    def resident_variables(self):
+        with self._lock:
+            return list(self._resident)
+
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(mean_dir, std_dir, **kwargs):
+    # One catalog per data directory, shared across sessions
+    key = (str(mean_dir), str(std_dir))
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = VariableCatalog(mean_dir, std_dir, **kwargs)
+        return _catalogs[key]
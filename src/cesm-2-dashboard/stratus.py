@@ -73,11 +73,55 @@ def download_file(filename, bucketname):
             s3_client.download_file(bucketname, filename, filename)
 
 def get_data_files():
-    bucket_objs = list_bucket_objs('cisl-cloud-users')
-    for objs in bucket_objs:
-        if 'LENS2-ncote-dashboard/data_files' in objs:
-            if '.tar.gz' in objs:
-                pass
-            else:
-                print('Downloading ' + objs)
-                download_file(objs,'cisl-cloud-users')
\ No newline at end of file
+    # Download into the working directory, keeping the object keys as paths
+    sync_data_files('LENS2-ncote-dashboard/data_files')
+
+# Define a function to bring a local copy of the data files in line with the bucket.
+# Only new and updated objects are downloaded, and files removed from the bucket are deleted.
+# Files get the object's LastModified time, so the webapp and every Dask worker that synced
+# the same object report the same file signature (see file_signatures).
+def sync_data_files(root, prefix='LENS2-ncote-dashboard/data_files', bucketname='cisl-cloud-users'):
+    root = os.path.abspath(root)
+    s3_client = stratus_s3_client()
+    bucket = stratus_s3_resource().Bucket(bucketname)
+    synced = set()
+    updated = []
+    for obj in bucket.objects.filter(Prefix=prefix):
+        if '.tar.gz' in obj.key or obj.key.endswith('/'):
+            continue
+        path = os.path.join(root, os.path.relpath(obj.key, prefix))
+        synced.add(path)
+        mtime_ns = int(obj.last_modified.timestamp()) * 10**9
+        if file_signature(path) == (mtime_ns, obj.size):
+            continue
+        print('Downloading ' + obj.key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # download next to the file and rename, so readers never see a partial file
+        tmp = f'{path}.{os.getpid()}.tmp'
+        s3_client.download_file(bucketname, obj.key, tmp)
+        os.utime(tmp, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp, path)
+        updated.append(path)
+
+    # an empty listing more likely means a bucket problem than a deleted data set, keep the files
+    for directory, _, filenames in os.walk(root) if synced else ():
+        for filename in filenames:
+            path = os.path.join(directory, filename)
+            if filename.endswith('.nc') and path not in synced:
+                print('Removing ' + path)
+                os.remove(path)
+                updated.append(path)
+    return updated
+
+# Define a function returning (modification time, size) of a file, or None if it doesn't exist
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+# Define a function returning the signatures of several files, used to compare the
+# copies of the data files on the Dask workers with the ones the webapp reads
+def file_signatures(paths):
+    return {str(path): file_signature(path) for path in paths}
\ No newline at end of file
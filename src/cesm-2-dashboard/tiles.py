@@ -0,0 +1,350 @@
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import urlencode
+
+import numpy as np
+from PIL import Image
+from holoviews.plotting.util import process_cmap
+from tornado.ioloop import IOLoop
+from tornado.web import HTTPError, RequestHandler
+
+# This module serves pre-colormapped XYZ (Web Mercator) map tiles for the dashboard.
+# It is loaded as a Panel server plugin so the /tiles route lives next to the app:
+#   panel serve app.py --plugins tiles
+# app.py registers a frame source with `set_frame_source` and points `view_map` at `tile_url`.
+# The plugin and app.py must share this module (imported as `tiles`), otherwise the frame
+# source lands on a copy the route never sees; the Containerfile sets PYTHONPATH for that.
+
+TILE_SIZE = 256
+TILE_FORMATS = {'png': 'PNG', 'webp': 'WEBP'}
+
+# Colormaps offered by the dashboard, the tile route only renders these
+COLORMAPS = ['inferno', 'viridis', 'inferno_r', 'kb', 'coolwarm', 'coolwarm_r', 'Blues', 'Blues_r']
+
+# Bounded caches: rendered tile bytes in memory (LRU by total size) and on disk,
+# plus a handful of raw 2D frames so cold tiles of a popular frame skip Dask entirely
+TILE_CACHE_DIR = os.environ.get('TILE_CACHE_DIR', '/tmp/lens2-tiles')
+TILE_CACHE_MEMORY_BYTES = int(os.environ.get('TILE_CACHE_MEMORY_BYTES', 256 * 2**20))
+TILE_CACHE_DISK_BYTES = int(os.environ.get('TILE_CACHE_DISK_BYTES', 2 * 2**30))
+FRAME_CACHE_SIZE = int(os.environ.get('FRAME_CACHE_SIZE', 32))
+TILE_CACHE_PRUNE_INTERVAL = int(os.environ.get('TILE_CACHE_PRUNE_INTERVAL', 300))
+
+# Spherical Mercator radius used by gv.WMTS / Bokeh tile sources
+EARTH_RADIUS = 6378137.0
+
+
+class TileCache:
+    def __init__(self, max_memory_bytes, cache_dir=None, max_disk_bytes=0):
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return self.cache_dir / digest[:2] / f'{digest}.{key[-1]}'
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.cache_dir is None:
+            return None
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+        if self.cache_dir is None or self.max_disk_bytes <= 0:
+            return
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        # write-then-rename so concurrent readers never see a partial tile
+        tmp = path.parent / f'{path.name}.{threading.get_ident()}.tmp'
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _put_memory(self, key, data):
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= len(self._memory.pop(key))
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def discard(self, match):
+        # Drop in-memory tiles whose key matches; disk tiles are keyed by data version
+        # and simply age out once nothing requests them anymore
+        with self._lock:
+            for key in [key for key in self._memory if match(key)]:
+                self._memory_bytes -= len(self._memory.pop(key))
+
+    def prune_disk(self):
+        # Drop the least recently written tiles until the disk cache fits its budget.
+        # Tiles are written and replaced concurrently, so files may vanish mid-scan.
+        if self.cache_dir is None:
+            return
+        files = []
+        for directory in self.cache_dir.iterdir():
+            try:
+                entries = list(os.scandir(directory))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            total -= size
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def watch(self, interval):
+        # Prune the disk cache in a background thread instead of during tile requests
+        if self.cache_dir is None or getattr(self, '_pruner', None) is not None:
+            return
+        self._pruner = threading.Thread(
+            target=self._watch, args=(interval,), name='tile-cache-pruner', daemon=True
+        )
+        self._pruner.start()
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.prune_disk()
+            except Exception as e:
+                print(f'Tile cache pruning failed: {e}')
+
+
+tile_cache = TileCache(TILE_CACHE_MEMORY_BYTES, TILE_CACHE_DIR, TILE_CACHE_DISK_BYTES)
+tile_cache.watch(TILE_CACHE_PRUNE_INTERVAL)
+
+_frame_source = None
+_year_bounds = None
+_frames = OrderedDict()
+_frames_lock = threading.Lock()
+
+
+# The frame source maps (variable, forcing_type, year) to a 2D lat/lon DataArray and the
+# version of the data it was read from; year_bounds returns the (min, max) year the tile route accepts
+def set_frame_source(func, year_bounds=None):
+    global _frame_source, _year_bounds
+    _frame_source = func
+    _year_bounds = year_bounds
+
+
+# Called when the data behind a variable changed, see VariableCatalog.subscribe
+def invalidate(variables):
+    variables = set(variables)
+    with _frames_lock:
+        for key in [key for key in _frames if key[0] in variables]:
+            del _frames[key]
+    tile_cache.discard(lambda key: key[0] in variables)
+
+
+def on_catalog_change(added, changed, removed):
+    invalidate(changed + removed)
+
+
+class StaleFrameError(LookupError):
+    pass
+
+
+# `version` identifies the data behind a variable. Frames are only cached under the
+# version they were actually read from, a request for any other version is rejected.
+def get_frame(variable, forcing_type, year, version):
+    key = (variable, forcing_type, int(year), version)
+    with _frames_lock:
+        if key in _frames:
+            _frames.move_to_end(key)
+            return _frames[key]
+    if _frame_source is None:
+        raise LookupError('No frame source registered, call tiles.set_frame_source first')
+    da, current_version = _frame_source(variable, forcing_type, int(year))
+    if current_version != version:
+        raise StaleFrameError(f'{variable} is at version {current_version}, not {version}')
+    # store the frame with ascending coordinates so lookups can use searchsorted
+    da = da.sortby('lat').sortby('lon')
+    frame = (
+        np.asarray(da['lat'].values, dtype='float64'),
+        np.asarray(da['lon'].values, dtype='float64'),
+        np.asarray(da.transpose('lat', 'lon').values, dtype='float32'),
+    )
+    with _frames_lock:
+        _frames[key] = frame
+        while len(_frames) > FRAME_CACHE_SIZE:
+            _frames.popitem(last=False)
+    return frame
+
+
+def _colormap_lut(cmap):
+    colors = process_cmap(cmap, ncolors=256)
+    rgb = [tuple(int(c.lstrip('#')[i:i + 2], 16) for i in (0, 2, 4)) for c in colors]
+    lut = np.empty((256, 4), dtype='uint8')
+    lut[:, :3] = rgb
+    lut[:, 3] = 255
+    return lut
+
+
+_luts = {}
+
+
+def _nearest_index(coords, values):
+    # Index of the nearest coordinate for every value; -1 when outside the grid
+    edges = (coords[1:] + coords[:-1]) / 2
+    idx = np.searchsorted(edges, values)
+    half = (coords[-1] - coords[0]) / (len(coords) - 1) / 2 if len(coords) > 1 else 0
+    outside = (values < coords[0] - half) | (values > coords[-1] + half)
+    idx[outside] = -1
+    return idx
+
+
+def _nearest_lon_index(lons, values):
+    # Like _nearest_index, but wraps around the antimeridian on a global grid
+    values = (values - lons[0]) % 360 + lons[0]
+    idx = _nearest_index(lons, values)
+    if len(lons) > 1:
+        spacing = (lons[-1] - lons[0]) / (len(lons) - 1)
+        if np.isclose(lons[-1] + spacing - lons[0], 360):
+            idx[values > lons[-1] + spacing / 2] = 0
+    return idx
+
+
+def sample_frame(frame, lon, lat):
+    # Value of the grid cell nearest to (lon, lat), NaN outside the grid
+    lats, lons, values = frame
+    row = _nearest_index(lats, np.array([lat], dtype='float64'))[0]
+    col = _nearest_lon_index(lons, np.array([lon], dtype='float64'))[0]
+    if row < 0 or col < 0:
+        return np.nan
+    return float(values[row, col])
+
+
+def render_tile(frame, z, x, y, cmap, clim, fmt='png'):
+    lats, lons, values = frame
+    n = 2 ** z
+    offsets = (np.arange(TILE_SIZE) + 0.5) / TILE_SIZE
+    tile_lons = (x + offsets) / n * 360.0 - 180.0
+    tile_lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + offsets) / n))))
+
+    rows = _nearest_index(lats, tile_lats)
+    cols = _nearest_lon_index(lons, tile_lons)
+    pixels = values[np.ix_(np.maximum(rows, 0), np.maximum(cols, 0))]
+    missing = np.isnan(pixels) | (rows < 0)[:, None] | (cols < 0)[None, :]
+
+    low, high = clim
+    scale = 255.0 / (high - low) if high != low else 0.0
+    index = np.clip(np.nan_to_num((pixels - low) * scale), 0, 255).astype('uint8')
+    if cmap not in _luts:
+        _luts[cmap] = _colormap_lut(cmap)
+    rgba = _luts[cmap][index]
+    rgba[missing, 3] = 0
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(buffer, format=TILE_FORMATS[fmt])
+    return buffer.getvalue()
+
+
+def get_tile(variable, forcing_type, year, cmap, clim, z, x, y, fmt, version):
+    key = (variable, forcing_type, int(year), version, cmap, tuple(float(c) for c in clim), z, x, y, fmt)
+    data = tile_cache.get(key)
+    if data is not None:
+        return data
+    frame = get_frame(variable, forcing_type, year, version)
+    data = render_tile(frame, z, x, y, cmap, clim, fmt)
+    tile_cache.put(key, data)
+    return data
+
+
+# URL template for gv.WMTS, Bokeh fills in {X}, {Y} and {Z} for each visible tile
+def tile_url(variable, forcing_type, year, cmap, clim, version, prefix='', fmt='png'):
+    query = urlencode({
+        'variable': variable,
+        'forcing_type': forcing_type,
+        'year': int(year),
+        'version': version,
+        'cmap': cmap,
+        'clim': f'{clim[0]:.6g},{clim[1]:.6g}',
+    })
+    return f'{prefix}/tiles/{{Z}}/{{X}}/{{Y}}.{fmt}?{query}'
+
+
+def mercator_to_lonlat(x, y):
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return float(lon), float(lat)
+
+
+def lonlat_to_mercator(lon, lat):
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return float(x), float(y)
+
+
+class TileHandler(RequestHandler):
+    async def get(self, z, x, y, fmt):
+        z, x, y = int(z), int(x), int(y)
+        if z > 20 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise HTTPError(404)
+        try:
+            variable = self.get_argument('variable')
+            forcing_type = self.get_argument('forcing_type')
+            year = int(self.get_argument('year'))
+            cmap = self.get_argument('cmap')
+            clim = tuple(float(c) for c in self.get_argument('clim').split(','))
+            version = self.get_argument('version')
+        except ValueError:
+            raise HTTPError(400)
+        if len(clim) != 2 or not np.all(np.isfinite(clim)):
+            raise HTTPError(400)
+        if cmap not in COLORMAPS:
+            raise HTTPError(400)
+        if _year_bounds is not None:
+            min_year, max_year = _year_bounds()
+            if not min_year <= year <= max_year:
+                raise HTTPError(404)
+
+        try:
+            data = await IOLoop.current().run_in_executor(
+                None, get_tile, variable, forcing_type, year, cmap, clim, z, x, y, fmt, version
+            )
+        except LookupError:
+            raise HTTPError(404)
+
+        self.set_header('Content-Type', f'image/{fmt}')
+        self.set_header('Cache-Control', 'public, max-age=86400')
+        self.write(data)
+
+
+# Picked up by `panel serve --plugins tiles`
+ROUTES = [
+    (r'/tiles/(\d+)/(\d+)/(\d+)\.(png|webp)', TileHandler, {}),
+]
@@ -0,0 +1,44 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+# The dashboard modules live in a directory that is not a package
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src' / 'cesm-2-dashboard'))
+
+# tiles.py creates its disk cache on import, keep it out of /tmp/lens2-tiles
+os.environ.setdefault('TILE_CACHE_DIR', tempfile.mkdtemp(prefix='lens2-tiles-'))
+
+
+def write_variable(path, name, long_name, value=1.0, units='K', years=(2010, 2020),
+                   forcing_types=('cmip6', 'smbb')):
+    # Small LENS2-like file: (forcing_type, time, lat, lon) on a 0..360 longitude grid
+    time = pd.date_range(f'{years[0]}-01-01', f'{years[1]}-01-01', freq='YS')
+    lat = np.linspace(-90, 90, 7)
+    lon = np.arange(0, 360, 30.0)
+    data = np.full((len(forcing_types), len(time), len(lat), len(lon)), value, dtype='float32')
+    ds = xr.Dataset(
+        {name: (('forcing_type', 'time', 'lat', 'lon'), data, {'long_name': long_name, 'units': units})},
+        coords={'forcing_type': list(forcing_types), 'time': time, 'lat': lat, 'lon': lon},
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # replace like the Stratus sync does, the catalog may still have the old file open
+    tmp = path.with_suffix('.tmp')
+    ds.to_netcdf(tmp)
+    os.replace(tmp, path)
+    return path
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    # mean/ and std_dev/ directories with two variables
+    write_variable(tmp_path / 'mean' / 'TREFHT.nc', 'TREFHT', 'Reference height temperature', 280.0)
+    write_variable(tmp_path / 'std_dev' / 'TREFHT.nc', 'TREFHT', 'Reference height temperature', 2.0)
+    write_variable(tmp_path / 'mean' / 'PRECT.nc', 'PRECT', 'Total precipitation', 3.0, units='mm/day')
+    write_variable(tmp_path / 'std_dev' / 'PRECT.nc', 'PRECT', 'Total precipitation', 0.5, units='mm/day')
+    return tmp_path
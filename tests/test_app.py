@@ -0,0 +1,112 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('geoviews')
+pytest.importorskip('panel')
+
+
+@pytest.fixture(scope='module')
+def app(tmp_path_factory):
+    from conftest import write_variable
+
+    data = tmp_path_factory.mktemp('data_files')
+    write_variable(data / 'mean' / 'TREFHT.nc', 'TREFHT', 'Reference height temperature', 280.0)
+    write_variable(data / 'std_dev' / 'TREFHT.nc', 'TREFHT', 'Reference height temperature', 2.0)
+
+    env = {
+        'CLUSTER_TYPE': 'LocalCluster',
+        'LENS2_DATA_PATH': str(data),
+        'CATALOG_REFRESH_INTERVAL': '3600',
+    }
+    old = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        module = importlib.import_module('app')
+        yield module
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        module = sys.modules.pop('app', None)
+        if module is not None:
+            module.client.close()
+            module.cluster.close()
+
+
+@pytest.fixture(autouse=True)
+def offline_coastline(app, monkeypatch):
+    # gf.coastline downloads Natural Earth data when rendered, use an empty geo path instead
+    import types
+    import geoviews as gv
+    monkeypatch.setattr(app, 'gf', types.SimpleNamespace(coastline=gv.Path([])))
+
+
+def render(obj):
+    import holoviews as hv
+    return hv.renderer('bokeh').get_plot(obj)
+
+
+def test_app_and_plugin_share_tiles_module(app):
+    assert app.tiles is importlib.import_module('tiles')
+    assert app.tiles._frame_source is app.map_frame
+
+
+def test_tile_map_renders(app):
+    viewer = app.ClimateViewer()
+    assert app.USE_TILES
+    plot = render(viewer.view_map())
+    assert plot.state is not None
+
+
+def test_tile_map_renders_with_selection(app):
+    viewer = app.ClimateViewer()
+    viewer._selection.event(bounds=(-6e6, -6e6, 6e6, 6e6))
+    assert viewer._selection_bounds[0] == pytest.approx(-53.90, abs=0.01)
+    plot = render(viewer.view_map())
+    assert plot.state is not None
+
+
+def test_colorbar_proxy_does_not_carry_the_frame(app):
+    viewer = app.ClimateViewer()
+    assert viewer._cbar.data[viewer.variable].size == 4
+    assert viewer._cbar.range(viewer.variable) == tuple(viewer.cbar_controls.clim)
+
+
+def test_hover_reads_value_from_cached_frame(app):
+    viewer = app.ClimateViewer()
+    viewer._update_hover(*app.tiles.lonlat_to_mercator(10, 10))
+    assert viewer.hover_text.endswith(': 280')
+    viewer._update_hover(None, None)
+    assert viewer.hover_text == ''
+
+
+def test_tile_map_is_built_once_per_update(app, monkeypatch):
+    viewer = app.ClimateViewer()
+    calls = []
+    original = viewer._tile_layer
+    monkeypatch.setattr(viewer, '_tile_layer', lambda: calls.append(1) or original())
+    viewer.year = viewer.year + 1
+    assert len(calls) == 1
+
+
+def test_session_subsets_are_loaded(app):
+    # sessions must not keep dask graphs that pin the persisted variable
+    import dask.array
+    viewer = app.ClimateViewer()
+    viewer._selection.event(bounds=(-6e6, -6e6, 6e6, 6e6))
+    for dataset in (viewer.data_subset, viewer.ts_mean_subset, viewer.ts_upper_bound):
+        assert not isinstance(dataset.data[viewer.variable].data, dask.array.Array)
+    assert not isinstance(viewer.selection_ts_hv.data[viewer.variable].data, dask.array.Array)
+
+
+def test_workers_report_file_signatures(app):
+    from stratus import file_signature
+    path = str(app.data_catalog._files[app.variables[0]][1])
+    reports = app.worker_file_signatures([path])
+    assert reports and all(tuple(report[path]) == file_signature(path) for report in reports)
+    assert not app.SYNC_FROM_STRATUS
@@ -0,0 +1,132 @@
+import pytest
+
+from catalog import VariableCatalog
+from conftest import write_variable
+
+TREFHT = 'Reference height temperature (K)'
+PRECT = 'Total precipitation (mm/day)'
+
+
+@pytest.fixture
+def data_catalog(data_dir):
+    return VariableCatalog(data_dir / 'mean', data_dir / 'std_dev', persist=False)
+
+
+def test_variables_are_loaded_lazily(data_catalog):
+    assert data_catalog.variables == [PRECT, TREFHT]
+    assert data_catalog.forcing_types == ['cmip6', 'smbb']
+    assert (data_catalog.min_year, data_catalog.max_year) == (2010, 2020)
+    assert data_catalog.resident_variables == []
+
+    mean, std = data_catalog.get(TREFHT)
+    assert data_catalog.resident_variables == [TREFHT]
+    assert float(mean.isel(time=0, forcing_type=0).mean()) == 280
+    assert float(std.isel(time=0, forcing_type=0).mean()) == 2
+    # longitudes are normalized to [-180, 180)
+    assert float(mean.lon.min()) == -180
+
+
+def test_unknown_variable_is_not_tracked(data_catalog):
+    with pytest.raises(KeyError):
+        data_catalog.get('nope')
+    assert 'nope' not in data_catalog._last_used
+    assert 'nope' not in data_catalog._loading
+
+
+def test_least_recently_used_variable_is_evicted(data_catalog):
+    data_catalog.get(TREFHT)
+    # room for one variable (mean + std dev) only
+    data_catalog.memory_budget = data_catalog.resident_bytes
+    data_catalog.get(PRECT)
+    assert data_catalog.resident_variables == [PRECT]
+    data_catalog.get(TREFHT)
+    assert data_catalog.resident_variables == [TREFHT]
+    assert PRECT not in data_catalog._last_used
+
+
+def test_release_closes_files(data_catalog):
+    data_catalog.get(TREFHT)
+    mean_ds, std_ds = data_catalog._resident[TREFHT][3]
+    data_catalog.release(TREFHT)
+    assert data_catalog.resident_variables == []
+    assert TREFHT not in data_catalog._last_used
+    assert mean_ds._close is None and std_ds._close is None
+
+
+def test_peek_does_not_load_or_touch_last_use(data_catalog):
+    with pytest.raises(KeyError):
+        data_catalog.peek_versioned(TREFHT)
+    assert data_catalog.resident_variables == []
+    data_catalog.get(TREFHT)
+    last_used = data_catalog._last_used[TREFHT]
+    assert data_catalog.peek_versioned(TREFHT)[2] == data_catalog.version(TREFHT)
+    assert data_catalog._last_used[TREFHT] == last_used
+
+
+def test_std_file_with_different_raw_name(tmp_path):
+    write_variable(tmp_path / 'mean' / 'T.nc', 'TREFHT', 'Reference height temperature', 280.0)
+    write_variable(tmp_path / 'std_dev' / 'T.nc', 'TREFHT_std', 'Reference height temperature', 2.0)
+    data_catalog = VariableCatalog(tmp_path / 'mean', tmp_path / 'std_dev', persist=False)
+    mean, std = data_catalog.get(TREFHT)
+    assert float(std.isel(time=0, forcing_type=0).mean()) == 2
+
+
+def test_refresh_reports_added_changed_and_removed(data_catalog, data_dir):
+    events = []
+
+    def listener(added, changed, removed):
+        events.append((added, changed, removed))
+
+    data_catalog.subscribe(listener)
+    data_catalog.get(TREFHT)
+    version = data_catalog.version(TREFHT)
+
+    write_variable(data_dir / 'mean' / 'TREFHT.nc', 'TREFHT', 'Reference height temperature', 281.0, years=(2010, 2030))
+    write_variable(data_dir / 'mean' / 'PS.nc', 'PS', 'Surface pressure', 1e5, units='Pa')
+    write_variable(data_dir / 'std_dev' / 'PS.nc', 'PS', 'Surface pressure', 10.0, units='Pa')
+    (data_dir / 'mean' / 'PRECT.nc').unlink()
+    data_catalog.refresh()
+
+    assert events == [(['Surface pressure (Pa)'], [TREFHT], [PRECT])]
+    assert data_catalog.version(TREFHT) != version
+    assert data_catalog.variables == ['Surface pressure (Pa)', TREFHT]
+    assert data_catalog.max_year == 2030
+    # the resident variable was rebuilt from the new file
+    assert float(data_catalog.mean(TREFHT).isel(time=0, forcing_type=0).mean()) == 281
+
+    data_catalog.refresh()
+    assert len(events) == 1
+
+
+def test_refresh_waits_for_workers_to_have_the_same_files(data_catalog, data_dir):
+    from stratus import file_signatures
+
+    stale = {}
+    synced = []
+
+    def remote_signatures(paths):
+        # one worker up to date, one still holding the old copies
+        return [file_signatures(paths), {**file_signatures(paths), **stale}]
+
+    data_catalog.remote_signatures = remote_signatures
+    data_catalog.before_refresh = lambda: synced.append(True)
+    version = data_catalog.version(TREFHT)
+
+    write_variable(data_dir / 'mean' / 'TREFHT.nc', 'TREFHT', 'Reference height temperature', 281.0, years=(2010, 2030))
+    write_variable(data_dir / 'mean' / 'PS.nc', 'PS', 'Surface pressure', 1e5, units='Pa')
+    write_variable(data_dir / 'std_dev' / 'PS.nc', 'PS', 'Surface pressure', 10.0, units='Pa')
+    stale.update({
+        str(data_dir / 'mean' / 'TREFHT.nc'): (0, 0),
+        str(data_dir / 'mean' / 'PS.nc'): None,
+    })
+    data_catalog.refresh()
+    assert synced == [True]
+    assert data_catalog.version(TREFHT) == version
+    assert data_catalog.variables == [PRECT, TREFHT]
+    assert data_catalog.max_year == 2020
+
+    stale.clear()
+    data_catalog.refresh()
+    assert data_catalog.version(TREFHT) != version
+    assert data_catalog.variables == [PRECT, 'Surface pressure (Pa)', TREFHT]
+    assert data_catalog.max_year == 2030
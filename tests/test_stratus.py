@@ -0,0 +1,72 @@
+import types
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip('boto3')
+
+import stratus
+
+PREFIX = 'LENS2-ncote-dashboard/data_files'
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    # {key: (contents, last modified)} served through the boto3 calls sync_data_files makes
+    objects = {}
+    downloads = []
+
+    def download_file(bucketname, key, filename):
+        downloads.append(key)
+        with open(filename, 'wb') as f:
+            f.write(objects[key][0])
+
+    def filter(Prefix):
+        return [
+            types.SimpleNamespace(key=key, size=len(data), last_modified=modified)
+            for key, (data, modified) in objects.items() if key.startswith(Prefix)
+        ]
+
+    monkeypatch.setattr(stratus, 'stratus_s3_client', lambda: types.SimpleNamespace(download_file=download_file))
+    monkeypatch.setattr(stratus, 'stratus_s3_resource', lambda: types.SimpleNamespace(
+        Bucket=lambda name: types.SimpleNamespace(objects=types.SimpleNamespace(filter=filter))
+    ))
+    return objects, downloads
+
+
+def test_sync_downloads_only_changed_objects(bucket, tmp_path):
+    objects, downloads = bucket
+    t0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    objects[f'{PREFIX}/mean/T.nc'] = (b'mean', t0)
+    objects[f'{PREFIX}/std_dev/T.nc'] = (b'std', t0)
+    objects[f'{PREFIX}/data.tar.gz'] = (b'archive', t0)
+
+    stratus.sync_data_files(tmp_path)
+    assert sorted(downloads) == [f'{PREFIX}/mean/T.nc', f'{PREFIX}/std_dev/T.nc']
+    path = tmp_path / 'mean' / 'T.nc'
+    assert path.read_bytes() == b'mean'
+    # the signature is derived from the object, so every copy reports the same one
+    assert stratus.file_signature(path) == (int(t0.timestamp()) * 10**9, 4)
+
+    downloads.clear()
+    objects[f'{PREFIX}/mean/T.nc'] = (b'mean2', datetime(2024, 2, 1, tzinfo=timezone.utc))
+    del objects[f'{PREFIX}/std_dev/T.nc']
+    stratus.sync_data_files(tmp_path)
+    assert downloads == [f'{PREFIX}/mean/T.nc']
+    assert path.read_bytes() == b'mean2'
+    assert not (tmp_path / 'std_dev' / 'T.nc').exists()
+    assert not [p for p in tmp_path.rglob('*.tmp')]
+
+
+def test_sync_keeps_files_when_listing_is_empty(bucket, tmp_path):
+    (tmp_path / 'mean').mkdir()
+    (tmp_path / 'mean' / 'T.nc').write_bytes(b'mean')
+    stratus.sync_data_files(tmp_path)
+    assert (tmp_path / 'mean' / 'T.nc').exists()
+
+
+def test_file_signatures(tmp_path):
+    (tmp_path / 'a.nc').write_bytes(b'abc')
+    signatures = stratus.file_signatures([tmp_path / 'a.nc', tmp_path / 'b.nc'])
+    assert signatures[str(tmp_path / 'a.nc')][1] == 3
+    assert signatures[str(tmp_path / 'b.nc')] is None
@@ -0,0 +1,166 @@
+import io
+import os
+import time
+
+import numpy as np
+import pytest
+import xarray as xr
+from PIL import Image
+
+import tiles
+
+
+def global_frame(values):
+    lats = np.linspace(-90, 90, values.shape[0])
+    lons = np.arange(-180, 180, 360 / values.shape[1])
+    return lats, lons, values.astype('float32')
+
+
+def decode(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGBA'))
+
+
+def test_render_tile_north_is_up_and_east_is_right():
+    lats, lons, _ = global_frame(np.zeros((19, 36)))
+    values = lats[:, None] + 0 * lons[None, :]
+    rgba = decode(tiles.render_tile((lats, lons, values), 0, 0, 0, 'Blues', (-90, 90)))
+    # Blues darkens with the value: high latitudes at the top of the tile, low at the bottom
+    assert rgba[0, 128, 1] < rgba[128, 128, 1] < rgba[-1, 128, 1]
+
+    values = lons[None, :] + 0 * lats[:, None]
+    rgba = decode(tiles.render_tile((lats, lons, values), 0, 0, 0, 'Blues', (-180, 180)))
+    # west on the left, east on the right
+    assert rgba[128, 250, 1] < rgba[128, 128, 1] < rgba[128, 5, 1]
+
+
+def test_render_tile_masks_nan_and_scales_with_clim():
+    lats, lons, values = global_frame(np.ones((19, 36)))
+    values[:, :18] = np.nan
+    rgba = decode(tiles.render_tile((lats, lons, values), 0, 0, 0, 'inferno', (0, 1)))
+    assert rgba[128, 10, 3] == 0
+    assert rgba[128, 250, 3] == 255
+    assert tuple(rgba[128, 250]) == tuple(tiles._colormap_lut('inferno')[255])
+
+
+def test_nearest_lon_index_wraps_at_antimeridian():
+    lons = np.arange(-180, 180, 1.25)
+    idx = tiles._nearest_lon_index(lons, np.array([179.0, 179.5, 179.99, -180.5, 180.0, 0.3]))
+    assert idx.tolist() == [len(lons) - 1, 0, 0, 0, 0, 144]
+
+
+def test_nearest_lon_index_does_not_wrap_regional_grid():
+    lons = np.arange(0, 90, 1.0)
+    idx = tiles._nearest_lon_index(lons, np.array([45.2, 120.0, -10.0]))
+    assert idx.tolist() == [45, -1, -1]
+
+
+def test_render_tile_has_no_seam_at_antimeridian():
+    lats, lons, values = global_frame(np.ones((145, 288)))
+    rgba = decode(tiles.render_tile((lats, lons, values), 1, 1, 0, 'inferno', (0, 2)))
+    assert (rgba[:, -1, 3] == 255).all()
+
+
+def test_sample_frame():
+    lats, lons, _ = global_frame(np.zeros((19, 36)))
+    values = lats[:, None] + lons[None, :] / 1000
+    assert tiles.sample_frame((lats, lons, values), 10, 20) == pytest.approx(20.01)
+    assert tiles.sample_frame((lats, lons, values), 179.9, 0) == pytest.approx(-0.18)
+
+
+def test_mercator_round_trip():
+    x, y = tiles.lonlat_to_mercator(-120.5, 33.25)
+    assert tiles.mercator_to_lonlat(x, y) == pytest.approx((-120.5, 33.25))
+
+
+def test_tile_cache_memory_lru_is_bounded():
+    cache = tiles.TileCache(max_memory_bytes=25)
+    for i in range(5):
+        cache.put(('v', i, 'png'), b'x' * 10)
+    assert cache.get(('v', 0, 'png')) is None
+    assert cache.get(('v', 3, 'png')) == b'x' * 10
+    cache.put(('v', 5, 'png'), b'x' * 10)
+    # 3 was used more recently than 4, so 4 is evicted first
+    assert cache.get(('v', 4, 'png')) is None
+    assert cache.get(('v', 3, 'png')) is not None
+    assert cache._memory_bytes <= 25
+
+
+def test_tile_cache_falls_back_to_disk(tmp_path):
+    cache = tiles.TileCache(max_memory_bytes=10, cache_dir=tmp_path, max_disk_bytes=1000)
+    cache.put(('a', 'png'), b'a' * 10)
+    cache.put(('b', 'png'), b'b' * 10)
+    assert ('a', 'png') not in cache._memory
+    assert cache.get(('a', 'png')) == b'a' * 10
+
+
+def test_prune_disk_keeps_newest_within_budget(tmp_path):
+    cache = tiles.TileCache(max_memory_bytes=0, cache_dir=tmp_path, max_disk_bytes=25)
+    for i in range(5):
+        cache.put((i, 'png'), b'x' * 10)
+        path = cache._path((i, 'png'))
+        os.utime(path, (time.time() + i, time.time() + i))
+    # an in-flight temporary file is neither counted nor removed
+    tmp = tmp_path / 'ab' / 'tile.png.1.tmp'
+    tmp.parent.mkdir(exist_ok=True)
+    tmp.write_bytes(b'x' * 100)
+
+    cache.prune_disk()
+    remaining = [i for i in range(5) if cache._path((i, 'png')).exists()]
+    assert remaining == [3, 4]
+    assert tmp.exists()
+
+
+def test_prune_disk_tolerates_files_vanishing(tmp_path, monkeypatch):
+    cache = tiles.TileCache(max_memory_bytes=0, cache_dir=tmp_path, max_disk_bytes=0)
+    cache.put(('a', 'png'), b'x' * 10)
+    path = cache._path(('a', 'png'))
+    real_scandir = os.scandir
+
+    def scandir_then_delete(directory):
+        entries = list(real_scandir(directory))
+        path.unlink(missing_ok=True)
+        return entries
+
+    monkeypatch.setattr(tiles.os, 'scandir', scandir_then_delete)
+    cache.prune_disk()
+
+
+@pytest.fixture
+def frame_source(monkeypatch):
+    state = {'version': 'v1', 'calls': 0}
+
+    def source(variable, forcing_type, year):
+        state['calls'] += 1
+        if variable != 'T':
+            raise KeyError(variable)
+        lats, lons, values = global_frame(np.full((19, 36), float(year)))
+        da = xr.DataArray(values, coords={'lat': lats, 'lon': lons}, dims=('lat', 'lon'))
+        return da, state['version']
+
+    monkeypatch.setattr(tiles, '_frames', type(tiles._frames)())
+    monkeypatch.setattr(tiles, 'tile_cache', tiles.TileCache(2**20))
+    tiles.set_frame_source(source, year_bounds=lambda: (1850, 2100))
+    yield state
+    tiles.set_frame_source(None)
+
+
+def test_get_frame_is_cached_per_version(frame_source):
+    tiles.get_frame('T', 'cmip6', 2000, 'v1')
+    tiles.get_frame('T', 'cmip6', 2000, 'v1')
+    assert frame_source['calls'] == 1
+
+
+def test_get_frame_rejects_stale_version(frame_source):
+    frame_source['version'] = 'v2'
+    with pytest.raises(tiles.StaleFrameError):
+        tiles.get_frame('T', 'cmip6', 2000, 'v1')
+    # nothing was cached under the stale version
+    assert not any(key[3] == 'v1' for key in tiles._frames)
+    assert tiles.get_frame('T', 'cmip6', 2000, 'v2')[2][0, 0] == 2000
+
+
+def test_invalidate_drops_frames_and_tiles(frame_source):
+    tiles.get_tile('T', 'cmip6', 2000, 'inferno', (0, 1), 0, 0, 0, 'png', 'v1')
+    tiles.invalidate(['T'])
+    assert not tiles._frames
+    assert not tiles.tile_cache._memory